@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+
+# Index-independent helpers shared by ndvi.py and ndsi.py: band-stack checks, windowed reads,
+# the multi-date reducer, the output window plan, and the run reports.
+
+# system libraries and imports
+import json
+import re
+import sys
+import time
+import warnings
+
+# import third party
+import numpy as np
+from osgeo import gdal
+
+
+# BuildVRT resamples band files that differ onto their union extent - stop unless every band file already sits on the stack's grid
+def check_stack_grid(stack_dataset, refl_files):
+    if stack_dataset is None or stack_dataset.RasterCount != len(refl_files):
+        sys.exit("Could not stack %s" % ", ".join(refl_files))
+    full_grid = {'xOff': 0, 'yOff': 0, 'xSize': stack_dataset.RasterXSize, 'ySize': stack_dataset.RasterYSize}
+    for i, refl_file in enumerate(refl_files, 1):
+        source = stack_dataset.GetRasterBand(i).GetMetadataItem('source_0', 'vrt_sources')
+        for rect in ('SrcRect', 'DstRect'):
+            attrs = dict(re.findall(r'(\w+)="([^"]*)"', re.search(r'<%s ([^>]*)/>' % rect, source).group(1)))
+            if any(float(attrs[k]) != v for k, v in full_grid.items()):
+                sys.exit("%s is not on the same grid as %s" % (refl_file, refl_files[0]))
+
+
+# Dates are combined pixel by pixel, so every scene must be on the same grid
+def check_coregistered(stacks, files):
+    first_dataset = stacks[0][0]
+    for fn, (ds, _) in zip(files, stacks):
+        if ((ds.RasterXSize, ds.RasterYSize) != (first_dataset.RasterXSize, first_dataset.RasterYSize)
+                or ds.GetGeoTransform() != first_dataset.GetGeoTransform()
+                or ds.GetProjection() != first_dataset.GetProjection()):
+            sys.exit("%s is not co-registered with %s" % (fn, files[0]))
+
+
+# Read all bands for a window in one dataset-level call so interleaved blocks are only decoded once.
+# When the buffer is smaller than the window (preview), GDAL reads from overviews if present, else decimates.
+# ingest keeps running totals of pixel bytes returned and time spent reading.
+def read_window(stack_dataset, band_list, src_window, cols, rows, ingest):
+    t0 = time.time()
+    stack_array = stack_dataset.ReadAsArray(*src_window, buf_xsize=cols, buf_ysize=rows, band_list=band_list)
+    ingest['time'] += time.time() - t0
+    ingest['bytes'] += stack_array.nbytes
+
+    # Convert to numpy array of specified type
+    return stack_array.astype('float32')
+
+
+# Band level GDAL reads a window into a cols x rows buffer from - the band itself or one of its overviews.
+# Follows GDAL's nearest-neighbour choice: the coarsest overview whose resolution, on its finer axis, is below
+# the requested one times GDAL_OVERVIEW_OVERSAMPLING_THRESHOLD (default 1.2)
+def overview_level(band, src_window, cols, rows):
+    _, _, w, h = src_window
+    if cols >= w and rows >= h:
+        return band
+    desired = min(w / cols, h / rows)
+    threshold = float(gdal.GetConfigOption('GDAL_OVERVIEW_OVERSAMPLING_THRESHOLD', '1.2'))
+
+    level = band
+    best = 1.0
+    for i in range(band.GetOverviewCount()):
+        ovr = band.GetOverview(i)
+        if ovr is None or ovr.XSize > band.XSize or ovr.YSize > band.YSize:
+            continue
+        resolution = min(band.XSize / ovr.XSize, band.YSize / ovr.YSize)
+        if resolution >= desired * threshold or resolution <= best:
+            continue
+        level = ovr
+        best = resolution
+    return level
+
+
+# Reduce an index across dates for one window, without keeping per-date rasters.
+# index_window(stack, src_window, cols, rows) returns one date's index array and its valid-pixel mask.
+def composite_window(stacks, index_window, src_window, cols, rows, composite_type, percentile):
+    count = np.zeros((rows, cols), dtype='int32')
+    if composite_type == 'max':
+        acc = np.full((rows, cols), -np.inf, dtype='float32')
+    elif composite_type == 'mean':
+        acc = np.zeros((rows, cols), dtype='float64')
+    elif composite_type in ('median', 'percentile'):
+        # Only this window is held for every date, so memory scales with window size x number of dates
+        acc = np.full((len(stacks), rows, cols), np.nan, dtype='float32')
+
+    for i, stack in enumerate(stacks):
+        index_array, valid_mask = index_window(stack, src_window, cols, rows)
+        count += valid_mask
+
+        if composite_type == 'max':
+            acc = np.where(valid_mask, np.maximum(acc, index_array), acc)
+        elif composite_type == 'mean':
+            acc += np.where(valid_mask, index_array, 0)
+        elif composite_type in ('median', 'percentile'):
+            acc[i][valid_mask] = index_array[valid_mask]
+
+    if composite_type == 'count':
+        return count.astype('float32')
+
+    if composite_type == 'max':
+        composite_array = acc
+    elif composite_type == 'mean':
+        composite_array = (acc / np.maximum(count, 1)).astype('float32')
+    else:
+        q = 50 if composite_type == 'median' else percentile
+        # All-NaN pixels (no valid date) are filled with nodata below
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            composite_array = np.nanpercentile(acc, q, axis=0).astype('float32')
+
+    composite_array[count == 0] = -32768
+    return composite_array
+
+
+# Output grid - reduced by the preview factor, full resolution otherwise.  Each output pixel
+# covers exactly preview_factor input pixels, dropping any partial pixel at the right and bottom edges
+def output_grid(stack_dataset, preview_factor):
+    xsize = stack_dataset.RasterXSize
+    ysize = stack_dataset.RasterYSize
+    out_xsize = xsize // preview_factor
+    out_ysize = ysize // preview_factor
+    if out_xsize == 0 or out_ysize == 0:
+        sys.exit("-preview factor %i is larger than the %i x %i input" % (preview_factor, xsize, ysize))
+
+    gt = stack_dataset.GetGeoTransform()
+    out_gt = (gt[0], gt[1] * preview_factor, gt[2] * preview_factor, gt[3], gt[4] * preview_factor, gt[5] * preview_factor)
+    return out_xsize, out_ysize, out_gt
+
+
+# Plan every window up front - the output block (x, y, cols, rows) and the input window it covers
+def plan_windows(out_xsize, out_ysize, x_block_size, y_block_size, preview_factor):
+    windows = []
+    for y in range(0, out_ysize, y_block_size):
+        if y + y_block_size < out_ysize:
+            rows = y_block_size
+        else:
+            rows = out_ysize - y
+        # Loop through columns
+        for x in range(0, out_xsize, x_block_size):
+            if x + x_block_size < out_xsize:
+                cols = x_block_size
+            else:
+                cols = out_xsize - x
+
+            # Input window covered by this output block
+            src_window = (x * preview_factor, y * preview_factor, cols * preview_factor, rows * preview_factor)
+            windows.append((x, y, cols, rows, src_window))
+    return windows
+
+
+# Report ingest rate of the band reads.  Bytes are the pixels GDAL returned, not the compressed bytes it
+# decoded - for previews that is the reduced-resolution buffer, however much input was decoded to fill it
+def report_read(label, blocks, dates, ingest):
+    print(label,
+          "Read:", blocks, "blocks x", dates, "date(s),",
+          "%.1f MB of pixels in %.2f s" % (ingest['bytes'] / 1e6, ingest['time']),
+          "(%.1f MB/s)" % (ingest['bytes'] / 1e6 / max(ingest['time'], 1e-6)))
+
+
+# Report the measured preview run, which level of each date's input GDAL read it from, and the measured
+# time of one full-resolution window of every date for comparison (a full run reads full_windows of them)
+def report_preview(label, files, stacks, preview_factor, out_xsize, out_ysize, windows, elapsed, x_block_size, y_block_size):
+    print(label,
+          "Preview 1/%i:" % preview_factor, out_xsize, "x", out_ysize,
+          "in", len(windows), "window(s), %.2f s" % elapsed)
+
+    # GDAL chooses the level per read, so check it for a whole preview window of every date
+    _, _, cols, rows, src_window = windows[0]
+    for fn, (stack_dataset, band_list) in zip(files, stacks):
+        band = stack_dataset.GetRasterBand(band_list[0])
+        level = overview_level(band, src_window, cols, rows)
+        if level is not band:
+            source = "read from the %i x %i overview" % (level.XSize, level.YSize)
+        elif band.GetOverviewCount():
+            source = "decimated from full resolution - none of its %i overview(s) is fine enough" % band.GetOverviewCount()
+        else:
+            source = "decimated from full resolution - no overviews"
+        print(fn, "Preview source:", source)
+
+    stack_dataset = stacks[0][0]
+    xsize = stack_dataset.RasterXSize
+    ysize = stack_dataset.RasterYSize
+    cols = min(x_block_size, xsize)
+    rows = min(y_block_size, ysize)
+    sample = {'bytes': 0, 'time': 0.0}
+    for sample_dataset, band_list in stacks:
+        read_window(sample_dataset, band_list, (0, 0, cols, rows), cols, rows, sample)
+    full_windows = -(-xsize // x_block_size) * -(-ysize // y_block_size)
+    print(label,
+          "Full resolution:", xsize, "x", ysize, "in", full_windows, "window(s),",
+          "one", cols, "x", rows, "window x", len(stacks), "date(s) read in %.2f s" % sample['time'])
+
+
+# Report remote request count and bytes fetched
+def report_remote(label, range_cache):
+    print(label,
+          "Remote:", range_cache.stats['requests'], "GET requests,",
+          range_cache.stats['bytes'], "bytes fetched,",
+          range_cache.stats['served'], "bytes served from local cache")
+
+    # GDAL's own counters - requests to the local cache plus any /vsis3/ inputs, which bypass it (GDAL >= 3.7)
+    if hasattr(gdal, 'NetworkStatsGetAsSerializedJSON'):
+        get_stats = json.loads(gdal.NetworkStatsGetAsSerializedJSON()).get('methods', {}).get('GET', {})
+        print(label,
+              "GDAL:", get_stats.get('count', 0), "GET requests,",
+              get_stats.get('downloaded_bytes', 0), "bytes downloaded")
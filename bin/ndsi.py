@@ -8,25 +8,52 @@
 import sys
 import argparse
 import struct
+import time
 
 # import third party
 import numpy as np
 from osgeo import gdal
 
+# import local
+import index_utils
+
 # Have user define input and output image filenames
 parser = argparse.ArgumentParser(description='Multispectral Image to NDSI Image Conversion Script with Normalized Difference Snow Index Measurement')
-parser.add_argument('-in', '--MS_input_file', help='Multiband MS image file', required=True)
-parser.add_argument('-in2', '--SWIR_input_file', help='Multiband SWIR image file for WV3', required=False)
+parser.add_argument('-in', '--MS_input_file', help='Multiband MS image file, or several co-registered dates when compositing', nargs='+', required=True)
+parser.add_argument('-in2', '--SWIR_input_file', help='Multiband SWIR image file for WV3, one per MS input', nargs='+', required=False)
 parser.add_argument('-in_sensor', '--input_satellite', help='Sensor name - either WV3 or L8', required=True)
 parser.add_argument('-in_ndsi', '--input_thresh', help='String of NDSI outfile type: either base or hall', required=False)
 parser.add_argument('-out', '--output_file', help='Where NDSI image is to be saved', required=True)
+parser.add_argument('-composite', '--composite_type', help='Reduce NDSI across input dates: max, mean, count, median, or percentile', choices=['max', 'mean', 'count', 'median', 'percentile'], required=False)
+parser.add_argument('-pct', '--percentile', help='Percentile used with -composite percentile, default is 50', type=float, default=50, required=False)
+parser.add_argument('-preview', '--preview', help='Quick look: compute NDSI at 1/factor resolution from input overviews (internal or .ovr sidecar) or decimated reads', type=int, default=1, required=False)
+parser.add_argument('-remote', '--remote_input', help='Inputs are http(s)://, s3:// or /vsi paths - http(s) inputs are read through a local range cache and prefetched a window ahead', action='store_true')
+parser.add_argument('-cache_mb', '--cache_size', help='On-disk block cache size in MB for remote inputs, shared between runs, default is 256', type=int, default=256, required=False)
+parser.add_argument('-cache_dir', '--cache_dir', help='On-disk block cache directory for remote inputs, default is rs_indices_cache in the system temp directory', required=False)
 args = parser.parse_args()
 
-multi_band_file = args.MS_input_file
-swir_file = args.SWIR_input_file
+multi_band_files = args.MS_input_file
+swir_files = args.SWIR_input_file
 sensor = args.input_satellite
 NDSI_type = args.input_thresh
 NDSI_file = args.output_file
+composite_type = args.composite_type
+percentile = args.percentile
+preview_factor = args.preview
+remote_input = args.remote_input
+cache_size = args.cache_size * 1024 * 1024
+cache_dir = args.cache_dir
+
+if composite_type is None and len(multi_band_files) > 1:
+    parser.error('multiple input files require -composite')
+if not 0 <= percentile <= 100:
+    parser.error('-pct percentile must be between 0 and 100')
+if preview_factor < 1:
+    parser.error('-preview factor must be at least 1')
+if sensor == 'WV3' and (swir_files is None or len(swir_files) != len(multi_band_files)):
+    parser.error('WV3 requires one -in2 SWIR file per -in MS file')
+if swir_files is None:
+    swir_files = [None] * len(multi_band_files)
 
 # Dictionary of data type conversions between gdal and numpy
 GDAL2NUMPY_DATA_TYPE_CONVERSION = {
@@ -41,43 +68,98 @@ GDAL2NUMPY_DATA_TYPE_CONVERSION = {
   11: "complex128",
 }
 
+if remote_input:
+    # import local - only needed for remote inputs
+    import remote_cache
+
+    # Skip listing remote directories.  Previews still probe for external .ovr sidecars, which EMPTY_DIR would hide
+    gdal.SetConfigOption('GDAL_DISABLE_READDIR_ON_OPEN', 'TRUE' if preview_factor > 1 else 'EMPTY_DIR')
+    gdal.SetConfigOption('CPL_VSIL_NETWORK_STATS_ENABLED', 'YES')
+
+    # Persistent on-disk cache of remote byte ranges, served to GDAL over localhost
+    range_cache = remote_cache.RangeCache(cache_dir, cache_size)
+    range_cache.serve()
+
+def vsi_path(fn):
+    return range_cache.vsi_path(fn) if remote_input else fn
+
+# Running totals of bytes read and time spent reading, to report the ingest rate
+ingest = {'bytes': 0, 'time': 0.0}
+
 # Extract the green, NIR, and SWIR bands (should be TOA reflectance values)
-if sensor == 'WV3':
-    ms_noext = multi_band_file[:-4]
-    swir_noext = swir_file[:-4]
-
-    # Open single-band files as general access read only
-    multi_band_dataset = gdal.Open(ms_noext + "_b3_toa_refl.tif", gdal.GA_ReadOnly)
-    green_band = multi_band_dataset.GetRasterBand(1)
-    nir_dataset = gdal.Open(ms_noext + "_b7_toa_refl.tif", gdal.GA_ReadOnly)
-    swir_dataset = gdal.Open(swir_noext + "_b3_toa_refl.tif", gdal.GA_ReadOnly)
-    nir_band = nir_dataset.GetRasterBand(1)
-    swir_band = swir_dataset.GetRasterBand(1)
-
-else:
-    # L8 sensor level 1 imagery
-    green = 3
-    nir = 5
-    swir = 6
-
-    # Open single-band files as general access read only
-    multi_band_dataset = gdal.Open(multi_band_file, gdal.GA_ReadOnly)
-    green_band = multi_band_dataset.GetRasterBand(green)
-    nir_band = multi_band_dataset.GetRasterBand(nir)
-    swir_band = multi_band_dataset.GetRasterBand(swir)
-
-
-# Print out general information on dataset - choose green band
-print(multi_band_file,
-      "Driver:", multi_band_dataset.GetDriver().ShortName,
-      "/", multi_band_dataset.GetDriver().LongName)
-print(multi_band_file,
-      "Size:", multi_band_dataset.RasterXSize,
-      "x", multi_band_dataset.RasterYSize,
-      "x", multi_band_dataset.RasterCount)
-
-xsize = green_band.XSize
-ysize = green_band.YSize
+def open_stack(multi_band_file, swir_file):
+    if sensor == 'WV3':
+        ms_noext = multi_band_file[:-4]
+        swir_noext = swir_file[:-4]
+
+        green_refl_file = ms_noext + "_b3_toa_refl.tif"
+        nir_refl_file = ms_noext + "_b7_toa_refl.tif"
+        swir_refl_file = swir_noext + "_b3_toa_refl.tif"
+
+        # Stack the single-band files into a virtual dataset so each window is read in one call
+        refl_files = [green_refl_file, nir_refl_file, swir_refl_file]
+        stack_dataset = gdal.BuildVRT('', [vsi_path(fn) for fn in refl_files], separate=True)
+        index_utils.check_stack_grid(stack_dataset, refl_files)
+
+        # The VRT hides its sources' tile layout, so remote band files are opened again to plan their byte ranges
+        if remote_input:
+            for fn in refl_files:
+                if fn.startswith(('http://', 'https://')):
+                    range_cache.add_source(fn, gdal.Open(vsi_path(fn), gdal.GA_ReadOnly), [1])
+        band_list = [1, 2, 3]
+
+    else:
+        # L8 sensor level 1 imagery
+        green = 3
+        nir = 5
+        swir = 6
+
+        # Open single-band files as general access read only
+        band_list = [green, nir, swir]
+        stack_dataset = gdal.Open(vsi_path(multi_band_file), gdal.GA_ReadOnly)
+        if remote_input:
+            range_cache.add_source(multi_band_file, stack_dataset, band_list)
+
+    # Print out general information on dataset - choose green band
+    print(multi_band_file,
+          "Driver:", stack_dataset.GetDriver().ShortName,
+          "/", stack_dataset.GetDriver().LongName)
+    print(multi_band_file,
+          "Size:", stack_dataset.RasterXSize,
+          "x", stack_dataset.RasterYSize,
+          "x", stack_dataset.RasterCount)
+
+    return stack_dataset, band_list
+
+def calc_ndsi(green_band_array, nir_band_array, swir_band_array):
+    # Calculate NDSI
+    ndsi_array = (green_band_array - swir_band_array) / (green_band_array + swir_band_array)
+
+    # Create mask of valid pixels - those with positive reflectance values <=1 in the green and swir bands.  Work around green + swir = 0 in denominator
+    green_swir_mask = (green_band_array > 0) & (green_band_array <=1) & (swir_band_array >= 0) & (swir_band_array <=1)
+    ndsi_array = np.ma.array(ndsi_array, mask=~(green_swir_mask), fill_value=-32768)
+
+    # Adjust NDSI values based on modified version of Hall's threshold method
+    if NDSI_type == "hall":
+        hall_mask = (nir_band_array >= 0.1) & (nir_band_array <=1) & (ndsi_array >= 0.4) & (ndsi_array <= 1.0) & (green_band_array>=0.1)
+        ndsi_array=np.ma.array(ndsi_array, mask=~(hall_mask), fill_value=-32768)
+
+    return ndsi_array
+
+# NDSI and its valid-pixel mask for one date's window
+def ndsi_window(stack, src_window, cols, rows):
+    stack_dataset, band_list = stack
+    green_band_array, nir_band_array, swir_band_array = index_utils.read_window(stack_dataset, band_list, src_window, cols, rows, ingest)
+    ndsi_array = calc_ndsi(green_band_array, nir_band_array, swir_band_array)
+    valid_mask = ~np.ma.getmaskarray(ndsi_array) & np.isfinite(ndsi_array.data)
+    return ndsi_array.data, valid_mask
+
+stacks = [open_stack(ms, sw) for ms, sw in zip(multi_band_files, swir_files)]
+multi_band_file = multi_band_files[0]
+stack_dataset, band_list = stacks[0]
+index_utils.check_coregistered(stacks, multi_band_files)
+
+out_xsize, out_ysize, out_gt = index_utils.output_grid(stack_dataset, preview_factor)
 
 # Populate NDSI raster, use data blocks to save on memory usage
 
@@ -88,13 +170,22 @@ x_block_size = 1024 #block_sizes[0]
 y_block_size = 1024 #block_sizes[1]
 
 
+windows = index_utils.plan_windows(out_xsize, out_ysize, x_block_size, y_block_size, preview_factor)
+plans = [range_cache.plan(src_window, cols, rows) for _, _, cols, rows, src_window in windows] if remote_input else []
+
+# The current and next windows are pinned in the cache while they are read, so it has to hold both
+if remote_input:
+    min_cache_size = range_cache.min_bytes(plans)
+    if cache_size < min_cache_size:
+        parser.error('-cache_mb must be at least %i to hold two windows of remote reads' % -(-min_cache_size // (1024 * 1024)))
+
 #Create NDSI output raster with specific raster format
 driver = gdal.GetDriverByName('GTiff')
 
 NDSI_dataset = driver.Create(
     NDSI_file,
-    multi_band_dataset.RasterXSize,
-    multi_band_dataset.RasterYSize,
+    out_xsize,
+    out_ysize,
     1, # number of output bands -- just need one for NDSI
     6, # float32
     options=['TILED=YES',
@@ -105,59 +196,54 @@ NDSI_dataset = driver.Create(
             ])
 
 # Match the geotransform and projection to that of the input image
-NDSI_dataset.SetGeoTransform(multi_band_dataset.GetGeoTransform())
-NDSI_dataset.SetProjection(multi_band_dataset.GetProjection())
+NDSI_dataset.SetGeoTransform(out_gt)
+NDSI_dataset.SetProjection(stack_dataset.GetProjection())
 
 ndsi_band_out = NDSI_dataset.GetRasterBand(1)
 ndsi_band_out.SetNoDataValue(-32768)
 
 blocks = 0
+t_start = time.time()
 
-# loop through rows
-for y in range(0, ysize, y_block_size):
-    if y + y_block_size < ysize:
-        rows = y_block_size
-    else:
-        rows = ysize - y
+if plans:
+    # Fetch the first window now; each later window is fetched in the background while the one before it is computed
+    range_cache.prefetch(plans[0]).result()
 
-    # Loop through columns
-    for x in range(0, xsize, x_block_size):
-        if x + x_block_size < xsize:
-            cols = x_block_size
-        else:
-            cols = xsize - x
+for i, (x, y, cols, rows, src_window) in enumerate(windows):
+    if i + 1 < len(plans):
+        range_cache.prefetch(plans[i + 1])
 
-        # Read GDAL dataset as numpy array of specified type
-        green_band_array = green_band.ReadAsArray(x, y, cols, rows).astype('float32')
-        nir_band_array = nir_band.ReadAsArray(x, y, cols, rows).astype('float32')
-        swir_band_array = swir_band.ReadAsArray(x, y, cols, rows).astype('float32')
+    if composite_type is not None:
+        ndsi_array = index_utils.composite_window(stacks, ndsi_window, src_window, cols, rows, composite_type, percentile)
+        ndsi_band_out.WriteArray(ndsi_array, x, y)
+        ndsi_array = None
+        blocks += 1
+        continue
 
-        # Calculate NDSI
-        ndsi_array = (green_band_array - swir_band_array) / (green_band_array + swir_band_array)
+    # Calculate NDSI
+    ndsi_array, valid_mask = ndsi_window(stacks[0], src_window, cols, rows)
+    ndsi_array = np.ma.array(ndsi_array, mask=~(valid_mask), fill_value=-32768)
 
-        # Create mask of valid pixels - those with positive reflectance values <=1 in the green and swir bands.  Work around green + swir = 0 in denominator
-        green_swir_mask = (green_band_array > 0) & (green_band_array <=1) & (swir_band_array >= 0) & (swir_band_array <=1)
-        ndsi_array = np.ma.array(ndsi_array, mask=~(green_swir_mask), fill_value=-32768)
+    # Write this chunk to memory - WriteArray ignores numpy masks, so fill masked pixels with nodata first
+    ndsi_band_out.WriteArray(ndsi_array.filled(), x, y)
 
-        # Adjust NDSI values based on modified version of Hall's threshold method
-        if NDSI_type == "hall":
-            hall_mask = (nir_band_array >= 0.1) & (nir_band_array <=1) & (ndsi_array >= 0.4) & (ndsi_array <= 1.0) & (green_band_array>=0.1)
-            ndsi_array=np.ma.array(ndsi_array, mask=~(hall_mask), fill_value=-32768)
+    mask_array = None
+    ndsi_array = None
 
-        # Write this chunk to memory
-        ndsi_band_out.WriteArray(ndsi_array, x, y)
+    blocks += 1
 
-        green_band_array = None
-        swir_band_array = None
-        nir_band_array = None
-        mask_array = None
-        ndsi_array = None
-
-        blocks += 1
+index_utils.report_read(multi_band_file, blocks, len(stacks), ingest)
+if remote_input:
+    index_utils.report_remote(multi_band_file, range_cache)
+# Reported last - the full-resolution sample read is not part of the run's reads above
+if preview_factor > 1:
+    index_utils.report_preview(multi_band_file, multi_band_files, stacks, preview_factor, out_xsize, out_ysize,
+                               windows, time.time() - t_start, x_block_size, y_block_size)
 
-# Set dataset and bands to None to clear memory usage
-green_band = None
-swir_band = None
-nir_band = None
-multi_band_dataset = None
+# Set datasets to None to clear memory usage
+stacks = None
+stack_dataset = None
 NDSI_dataset = None
+
+if remote_input:
+    range_cache.close()
@@ -8,21 +8,44 @@
 import sys
 import argparse
 import struct
+import time
 
 # import third party
 import numpy as np
 from osgeo import gdal
 
+# import local
+import index_utils
+
 # Have user define input and output image filenames
 parser = argparse.ArgumentParser(description='GeoTiff Multi Spectral Image to NDVI Image Conversion Script with Normalized Difference Vegetation Index Measurement')
-parser.add_argument('-in', '--input_file', help='Multiband MS image file', required=True)
+parser.add_argument('-in', '--input_file', help='Multiband MS image file, or several co-registered dates when compositing', nargs='+', required=True)
 parser.add_argument('-in_sensor', '--input_satellite', help='Sensor name - either WV3 or L8', required=True)
 parser.add_argument('-out', '--output_file', help='Where NDVI image is to be saved', required=True)
+parser.add_argument('-composite', '--composite_type', help='Reduce NDVI across input dates: max, mean, count, median, or percentile', choices=['max', 'mean', 'count', 'median', 'percentile'], required=False)
+parser.add_argument('-pct', '--percentile', help='Percentile used with -composite percentile, default is 50', type=float, default=50, required=False)
+parser.add_argument('-preview', '--preview', help='Quick look: compute NDVI at 1/factor resolution from input overviews (internal or .ovr sidecar) or decimated reads', type=int, default=1, required=False)
+parser.add_argument('-remote', '--remote_input', help='Inputs are http(s)://, s3:// or /vsi paths - http(s) inputs are read through a local range cache and prefetched a window ahead', action='store_true')
+parser.add_argument('-cache_mb', '--cache_size', help='On-disk block cache size in MB for remote inputs, shared between runs, default is 256', type=int, default=256, required=False)
+parser.add_argument('-cache_dir', '--cache_dir', help='On-disk block cache directory for remote inputs, default is rs_indices_cache in the system temp directory', required=False)
 args = parser.parse_args()
 
-multi_band_file = args.input_file
+multi_band_files = args.input_file
 sensor = args.input_satellite
 NDVI_file = args.output_file
+composite_type = args.composite_type
+percentile = args.percentile
+preview_factor = args.preview
+remote_input = args.remote_input
+cache_size = args.cache_size * 1024 * 1024
+cache_dir = args.cache_dir
+
+if composite_type is None and len(multi_band_files) > 1:
+    parser.error('multiple input files require -composite')
+if not 0 <= percentile <= 100:
+    parser.error('-pct percentile must be between 0 and 100')
+if preview_factor < 1:
+    parser.error('-preview factor must be at least 1')
 
 # dictionary of data type conversion between gdal and numpy
 GDAL2NUMPY_DATA_TYPE_CONVERSION = {
@@ -37,44 +60,91 @@ GDAL2NUMPY_DATA_TYPE_CONVERSION = {
   11: "complex128",
 }
 
+if remote_input:
+    # import local - only needed for remote inputs
+    import remote_cache
+
+    # Skip listing remote directories.  Previews still probe for external .ovr sidecars, which EMPTY_DIR would hide
+    gdal.SetConfigOption('GDAL_DISABLE_READDIR_ON_OPEN', 'TRUE' if preview_factor > 1 else 'EMPTY_DIR')
+    gdal.SetConfigOption('CPL_VSIL_NETWORK_STATS_ENABLED', 'YES')
+
+    # Persistent on-disk cache of remote byte ranges, served to GDAL over localhost
+    range_cache = remote_cache.RangeCache(cache_dir, cache_size)
+    range_cache.serve()
+
+def vsi_path(fn):
+    return range_cache.vsi_path(fn) if remote_input else fn
+
+# Running totals of bytes read and time spent reading, to report the ingest rate
+ingest = {'bytes': 0, 'time': 0.0}
+
 # Extract the red and NIR bands (should be TOA reflectance values)
-if sensor == 'WV3':
-    # Remove file extension
-    ms_noext = multi_band_file[:-4]
-    
-    # Open single-band files as general access read only
-    multi_band_dataset = gdal.Open(ms_noext + "_b5_toa_refl.tif", gdal.GA_ReadOnly)
-    red_band = multi_band_dataset.GetRasterBand(1)
-    
-    nir_dataset = gdal.Open(ms_noext + "_b7_toa_refl.tif", gdal.GA_ReadOnly)
-    nir_band = nir_dataset.GetRasterBand(1)
-
-else:
-    if sensor == 'Planet':
-        red = 3
-        nir = 4
+def open_stack(multi_band_file):
+    if sensor == 'WV3':
+        # Remove file extension
+        ms_noext = multi_band_file[:-4]
+
+        red_refl_file = ms_noext + "_b5_toa_refl.tif"
+        nir_refl_file = ms_noext + "_b7_toa_refl.tif"
+
+        # Stack the single-band files into a virtual dataset so each window is read in one call
+        refl_files = [red_refl_file, nir_refl_file]
+        stack_dataset = gdal.BuildVRT('', [vsi_path(fn) for fn in refl_files], separate=True)
+        index_utils.check_stack_grid(stack_dataset, refl_files)
+
+        # The VRT hides its sources' tile layout, so remote band files are opened again to plan their byte ranges
+        if remote_input:
+            for fn in refl_files:
+                if fn.startswith(('http://', 'https://')):
+                    range_cache.add_source(fn, gdal.Open(vsi_path(fn), gdal.GA_ReadOnly), [1])
+        band_list = [1, 2]
+
     else:
-        # L8 sensor level 1 imagery
-        red = 4
-        nir = 5
-
-    # Open single-band files as general access read only
-    multi_band_dataset = gdal.Open(multi_band_file, gdal.GA_ReadOnly)  
-    red_band = multi_band_dataset.GetRasterBand(red)
-    nir_band = multi_band_dataset.GetRasterBand(nir)
-
-# Print out general information on dataset
-print(multi_band_file, 
-      "Driver:", multi_band_dataset.GetDriver().ShortName, 
-      "/", multi_band_dataset.GetDriver().LongName)
-print(multi_band_file, 
-      "Size:", multi_band_dataset.RasterXSize, 
-      "x", multi_band_dataset.RasterYSize, 
-      "x", multi_band_dataset.RasterCount)
-
-# Extract rows and columns of bands
-xsize = red_band.XSize
-ysize = red_band.YSize
+        if sensor == 'Planet':
+            red = 3
+            nir = 4
+        else:
+            # L8 sensor level 1 imagery
+            red = 4
+            nir = 5
+
+        # Open single-band files as general access read only
+        band_list = [red, nir]
+        stack_dataset = gdal.Open(vsi_path(multi_band_file), gdal.GA_ReadOnly)
+        if remote_input:
+            range_cache.add_source(multi_band_file, stack_dataset, band_list)
+
+    # Print out general information on dataset
+    print(multi_band_file,
+          "Driver:", stack_dataset.GetDriver().ShortName,
+          "/", stack_dataset.GetDriver().LongName)
+    print(multi_band_file,
+          "Size:", stack_dataset.RasterXSize,
+          "x", stack_dataset.RasterYSize,
+          "x", stack_dataset.RasterCount)
+
+    return stack_dataset, band_list
+
+def calc_ndvi(red_band_array, nir_band_array):
+    # Calculate NDVI
+    ndvi_array = (nir_band_array - red_band_array) / (nir_band_array + red_band_array)
+
+    # Create mask of valid pixels - positive reflectance values <=1.  Work around red + nir = 0 in denominator
+    valid_mask = (red_band_array >= 0) & (red_band_array <=1) & (nir_band_array >= 0) & (nir_band_array <= 1) & np.isfinite(ndvi_array)
+    return ndvi_array, valid_mask
+
+# NDVI and its valid-pixel mask for one date's window
+def ndvi_window(stack, src_window, cols, rows):
+    stack_dataset, band_list = stack
+    red_band_array, nir_band_array = index_utils.read_window(stack_dataset, band_list, src_window, cols, rows, ingest)
+    return calc_ndvi(red_band_array, nir_band_array)
+
+stacks = [open_stack(multi_band_file) for multi_band_file in multi_band_files]
+multi_band_file = multi_band_files[0]
+stack_dataset, band_list = stacks[0]
+index_utils.check_coregistered(stacks, multi_band_files)
+
+out_xsize, out_ysize, out_gt = index_utils.output_grid(stack_dataset, preview_factor)
 
 # Populate NDSI raster, use data blocks to save on memory usage
 #block_sizes = green_band.GetBlockSize()
@@ -82,65 +152,80 @@ ysize = red_band.YSize
 x_block_size = 1024 #block_sizes[0]
 y_block_size = 1024 #block_sizes[1]
 
+windows = index_utils.plan_windows(out_xsize, out_ysize, x_block_size, y_block_size, preview_factor)
+plans = [range_cache.plan(src_window, cols, rows) for _, _, cols, rows, src_window in windows] if remote_input else []
+
+# The current and next windows are pinned in the cache while they are read, so it has to hold both
+if remote_input:
+    min_cache_size = range_cache.min_bytes(plans)
+    if cache_size < min_cache_size:
+        parser.error('-cache_mb must be at least %i to hold two windows of remote reads' % -(-min_cache_size // (1024 * 1024)))
+
 # Create NDVI output raster with specific raster format
 driver = gdal.GetDriverByName('GTiff')
 
 NDVI_dataset = driver.Create(
     NDVI_file,
-    multi_band_dataset.RasterXSize,
-    multi_band_dataset.RasterYSize,
+    out_xsize,
+    out_ysize,
     1, # number of output bands -- just need one for NDVI
     6, #float32
-    options=['TILED=YES', 
-             'BLOCKXSIZE=%i' % x_block_size, 
-             'BLOCKYSIZE=%i' % y_block_size, 
-             'BIGTIFF=IF_SAFER', 
+    options=['TILED=YES',
+             'BLOCKXSIZE=%i' % x_block_size,
+             'BLOCKYSIZE=%i' % y_block_size,
+             'BIGTIFF=IF_SAFER',
              'COMPRESS=LZW',
             ])
 
 # Match the geotransform and projection to that of the input image
-NDVI_dataset.SetGeoTransform(multi_band_dataset.GetGeoTransform())
-NDVI_dataset.SetProjection(multi_band_dataset.GetProjection())
+NDVI_dataset.SetGeoTransform(out_gt)
+NDVI_dataset.SetProjection(stack_dataset.GetProjection())
 
 ndvi_band_out = NDVI_dataset.GetRasterBand(1)
 ndvi_band_out.SetNoDataValue(-32768)
 
 blocks = 0
+t_start = time.time()
 
-# loop through rows
-for y in range(0, ysize, y_block_size):
-    if y + y_block_size < ysize:
-        rows = y_block_size
-    else:
-        rows = ysize - y
-    # Loop through columns
-    for x in range(0, xsize, x_block_size):
-        if x + x_block_size < xsize:
-            cols = x_block_size
-        else:
-            cols = xsize - x
-        
-        # Read GDAL dataset as numpy array of specified type
-        red_band_array = red_band.ReadAsArray(x, y, cols, rows).astype('float32')
-        nir_band_array = nir_band.ReadAsArray(x, y, cols, rows).astype('float32')
-
-        # Calculate NDVI
-        ndvi_array = (nir_band_array - red_band_array) / (nir_band_array + red_band_array)
-        
-        # Create mask of valid pixels - positive reflectance values <=1
-        valid_mask = (red_band_array >= 0) & (red_band_array <=1) & (nir_band_array >= 0) & (nir_band_array <= 1)        
-        ndvi_array = np.ma.array(ndvi_array, mask=valid_mask, fill_value=-32768)
-        ndvi_band_out.WriteArray(ndvi_array, x, y)
+if plans:
+    # Fetch the first window now; each later window is fetched in the background while the one before it is computed
+    range_cache.prefetch(plans[0]).result()
 
-        red_band_array = None
-        nir_band_array = None
-        mask_array = None
-        ndvi_array = None
+for i, (x, y, cols, rows, src_window) in enumerate(windows):
+    if i + 1 < len(plans):
+        range_cache.prefetch(plans[i + 1])
 
+    if composite_type is not None:
+        ndvi_array = index_utils.composite_window(stacks, ndvi_window, src_window, cols, rows, composite_type, percentile)
+        ndvi_band_out.WriteArray(ndvi_array, x, y)
+        ndvi_array = None
         blocks += 1
+        continue
+
+    # Calculate NDVI
+    ndvi_array, valid_mask = ndvi_window(stacks[0], src_window, cols, rows)
+    ndvi_array = np.ma.array(ndvi_array, mask=~(valid_mask), fill_value=-32768)
 
-# Set dataset and bands to None to clear memory usage
-red_band = None
-nir_band = None
-multi_band_dataset = None
+    # WriteArray ignores numpy masks, so fill masked pixels with nodata first
+    ndvi_band_out.WriteArray(ndvi_array.filled(), x, y)
+
+    mask_array = None
+    ndvi_array = None
+
+    blocks += 1
+
+index_utils.report_read(multi_band_file, blocks, len(stacks), ingest)
+if remote_input:
+    index_utils.report_remote(multi_band_file, range_cache)
+# Reported last - the full-resolution sample read is not part of the run's reads above
+if preview_factor > 1:
+    index_utils.report_preview(multi_band_file, multi_band_files, stacks, preview_factor, out_xsize, out_ysize,
+                               windows, time.time() - t_start, x_block_size, y_block_size)
+
+# Set datasets to None to clear memory usage
+stacks = None
+stack_dataset = None
 NDVI_dataset = None
+
+if remote_input:
+    range_cache.close()
@@ -0,0 +1,403 @@
+#!/usr/bin/env python
+
+# Local range cache for reading remote GeoTIFFs with ndvi.py and ndsi.py.
+# A small HTTP server on localhost answers GDAL's /vsicurl range requests from an on-disk cache of
+# fixed-size chunks keyed by URL and offset.  Chunks persist between runs, so tiles fetched by one
+# index script are reused by the next, and the cache is trimmed to a size limit (least recently used first).
+
+# system libraries and imports
+import collections
+import hashlib
+import math
+import os
+import re
+import tempfile
+import threading
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# import local
+import index_utils
+
+# Cached chunk size - tile byte ranges are rounded out to these
+CHUNK_SIZE = 256 * 1024
+
+DEFAULT_CACHE_DIR = os.path.join(tempfile.gettempdir(), 'rs_indices_cache')
+
+
+# Byte ranges of the TIFF blocks GDAL decodes for a window read into a cols x rows buffer,
+# as (band level read, ranges) - the level may be an overview held in an external .ovr file
+def block_ranges(band, src_window, cols, rows):
+    x, y, w, h = src_window
+    level = index_utils.overview_level(band, src_window, cols, rows)
+    x_scale = level.XSize / band.XSize
+    y_scale = level.YSize / band.YSize
+    x0, x1 = int(x * x_scale), min(math.ceil((x + w) * x_scale), level.XSize)
+    y0, y1 = int(y * y_scale), min(math.ceil((y + h) * y_scale), level.YSize)
+
+    block_xsize, block_ysize = level.GetBlockSize()
+    ranges = []
+    for by in range(y0 // block_ysize, (y1 - 1) // block_ysize + 1):
+        for bx in range(x0 // block_xsize, (x1 - 1) // block_xsize + 1):
+            offset = level.GetMetadataItem('BLOCK_OFFSET_%d_%d' % (bx, by), 'TIFF')
+            size = level.GetMetadataItem('BLOCK_SIZE_%d_%d' % (bx, by), 'TIFF')
+            # Sparse or non-TIFF blocks have no byte range to fetch
+            if offset and size:
+                ranges.append((int(offset), int(size)))
+    return level, ranges
+
+
+class RangeCache(object):
+
+    def __init__(self, cache_dir, max_bytes, workers=8):
+        self.cache_dir = cache_dir or DEFAULT_CACHE_DIR
+        self.max_bytes = max_bytes
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+        self.lock = threading.Lock()
+        self.in_flight = {}
+        self.pinned = collections.deque(maxlen=2)
+        self.reading = collections.Counter()
+        self.sizes = {}
+        self.stats = {'requests': 0, 'bytes': 0, 'served': 0}
+
+        # Remote http(s) files read through the cache, as (url, dataset, bands) - used to plan each window's byte ranges
+        self.sources = []
+
+        # Downloads run on the pool; prefetches are queued on their own thread so they never wait on the pool they feed
+        self.pool = ThreadPoolExecutor(workers)
+        self.prefetcher = ThreadPoolExecutor(1)
+        self.server = None
+
+    def _key(self, url):
+        return hashlib.sha1(url.encode('utf-8')).hexdigest()
+
+    def _chunk_path(self, url, i):
+        return os.path.join(self.cache_dir, '%s.%d' % (self._key(url), i))
+
+    # Length of the remote object, or None if it cannot be read.  Chunks cached for an older version are dropped.
+    # Probed with a one-byte ranged GET rather than HEAD, which presigned GET URLs reject.
+    def size(self, url):
+        with self.lock:
+            if url in self.sizes:
+                return self.sizes[url]
+
+        length = None
+        try:
+            req = urllib.request.Request(url, headers={'Range': 'bytes=0-0'})
+            with urllib.request.urlopen(req) as resp:
+                headers = resp.headers
+                status = resp.status
+            with self.lock:
+                self.stats['requests'] += 1
+                self.stats['bytes'] += 1 if status == 206 else 0
+        except urllib.error.HTTPError as e:
+            # An empty object has no byte 0, so the range is unsatisfiable - Content-Range still carries the length
+            headers = e.headers
+            status = e.code
+        except urllib.error.URLError:
+            headers = None
+            status = None
+
+        if status == 206 or status == 416:
+            match = re.match(r'bytes (?:\d+-\d+|\*)/(\d+)$', headers.get('Content-Range') or '')
+            if match:
+                length = int(match.group(1))
+        elif status == 200 and headers.get('Content-Length'):
+            # Server ignored the Range header - the response is the whole object
+            length = int(headers['Content-Length'])
+
+        if length is not None:
+            version = headers.get('ETag') or headers.get('Last-Modified') or ''
+            stamp = '%d %s' % (length, version)
+            stamp_path = os.path.join(self.cache_dir, self._key(url) + '.stamp')
+            try:
+                with open(stamp_path) as f:
+                    cached_stamp = f.read()
+            except IOError:
+                cached_stamp = None
+            if cached_stamp != stamp:
+                self._purge(url)
+                self._write(stamp_path, stamp.encode('utf-8'))
+
+        with self.lock:
+            self.sizes[url] = length
+        return length
+
+    def _purge(self, url):
+        prefix = self._key(url) + '.'
+        for name in os.listdir(self.cache_dir):
+            if name.startswith(prefix):
+                try:
+                    os.remove(os.path.join(self.cache_dir, name))
+                except FileNotFoundError:
+                    pass
+
+    # Write via a temporary file so other processes sharing the cache never see a partial chunk
+    def _write(self, path, data):
+        tmp_path = '%s.%d.%d.tmp' % (path, os.getpid(), threading.get_ident())
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    # Chunks touched by plan = [(url, [(offset, size), ...]), ...], as {url: (length, [chunk index, ...])}
+    def _chunks(self, plan):
+        chunks = {}
+        for url, ranges in plan:
+            length = self.size(url)
+            if length is None:
+                continue
+            needed = set(chunks[url][1]) if url in chunks else set()
+            for offset, size in ranges:
+                end = min(offset + size, length)
+                if end > offset:
+                    needed.update(range(offset // CHUNK_SIZE, (end - 1) // CHUNK_SIZE + 1))
+            chunks[url] = (length, sorted(needed))
+        return chunks
+
+    # Cache space a plan takes once fetched
+    def plan_bytes(self, plan):
+        return sum(len(indices) for _, indices in self._chunks(plan).values()) * CHUNK_SIZE
+
+    # Smallest cache that can pin the current and next windows of plans at once
+    def min_bytes(self, plans):
+        return 2 * max([self.plan_bytes(plan) for plan in plans] + [0])
+
+    # Make sure every chunk touched by plan is on disk.
+    # Runs of adjacent missing chunks become single range requests, all issued concurrently.
+    def fetch(self, plan):
+        claimed = []
+        waiting = []
+        for url, (length, indices) in self._chunks(plan).items():
+            run = []
+            with self.lock:
+                for i in indices:
+                    if (url, i) in self.in_flight:
+                        waiting.append(self.in_flight[(url, i)])
+                    elif not os.path.exists(self._chunk_path(url, i)):
+                        self.in_flight[(url, i)] = threading.Event()
+                        if run and i != run[-1] + 1:
+                            claimed.append((url, run, length))
+                            run = []
+                        run.append(i)
+            if run:
+                claimed.append((url, run, length))
+
+        futures = [self.pool.submit(self._download, url, run, length) for url, run, length in claimed]
+        for future in futures:
+            future.result()
+        for event in waiting:
+            event.wait()
+        if claimed:
+            self._evict()
+
+    # Bytes start..end (inclusive) of url in one range request
+    def _get(self, url, start, end):
+        req = urllib.request.Request(url, headers={'Range': 'bytes=%d-%d' % (start, end)})
+        with urllib.request.urlopen(req) as resp:
+            data = resp.read()
+            status = resp.status
+        with self.lock:
+            self.stats['requests'] += 1
+            self.stats['bytes'] += len(data)
+
+        # Server ignored the Range header and sent the whole object
+        if status == 200:
+            data = data[start:end + 1]
+        return data
+
+    def _download(self, url, run, length):
+        start = run[0] * CHUNK_SIZE
+        end = min((run[-1] + 1) * CHUNK_SIZE, length) - 1
+        try:
+            data = self._get(url, start, end)
+            for n, i in enumerate(run):
+                self._write(self._chunk_path(url, i), data[n * CHUNK_SIZE:(n + 1) * CHUNK_SIZE])
+        finally:
+            with self.lock:
+                for i in run:
+                    self.in_flight.pop((url, i)).set()
+
+    # Trim the cache to max_bytes, oldest chunks first.  Chunks of the current and next windows
+    # and of reads in progress are kept even if that leaves the cache over its limit.
+    def _evict(self):
+        with self.lock:
+            keep = set(self.reading)
+            for chunks in self.pinned:
+                keep.update(chunks)
+
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith('.stamp') or name.endswith('.tmp'):
+                continue
+            path = os.path.join(self.cache_dir, name)
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if path in keep:
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def _read_chunk(self, url, i):
+        path = self._chunk_path(url, i)
+        with open(path, 'rb') as f:
+            data = f.read()
+        # Mark as recently used for eviction
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        return data
+
+    # Bytes start..end (inclusive) of url, served from the cache
+    def read(self, url, start, end):
+        first = start // CHUNK_SIZE
+        paths = [self._chunk_path(url, i) for i in range(first, end // CHUNK_SIZE + 1)]
+        with self.lock:
+            self.reading.update(paths)
+        try:
+            self.fetch([(url, [(start, end - start + 1)])])
+            try:
+                data = b''.join(self._read_chunk(url, i) for i in range(first, end // CHUNK_SIZE + 1))
+                data = data[start - first * CHUNK_SIZE:end - first * CHUNK_SIZE + 1]
+            except FileNotFoundError:
+                # Evicted by another process sharing the cache - fetch the whole range in one request
+                data = self._get(url, start, end)
+        finally:
+            with self.lock:
+                for path in paths:
+                    self.reading[path] -= 1
+                    if not self.reading[path]:
+                        del self.reading[path]
+
+        with self.lock:
+            self.stats['served'] += len(data)
+        return data
+
+    # Fetch a plan in the background so the download overlaps the caller's compute.  The plan stays
+    # pinned against eviction until two later plans have been prefetched, which covers the window
+    # being read while the next one downloads.
+    def prefetch(self, plan):
+        return self.prefetcher.submit(self._prefetch, plan)
+
+    def _prefetch(self, plan):
+        chunks = set()
+        for url, (_, indices) in self._chunks(plan).items():
+            chunks.update(self._chunk_path(url, i) for i in indices)
+        with self.lock:
+            self.pinned.append(chunks)
+        self.fetch(plan)
+
+    # Start the localhost server GDAL reads through
+    def serve(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), _CacheHandler)
+        self.server.daemon_threads = True
+        self.server.cache = self
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    # GDAL path for an input - http(s) is read through the cache, s3:// goes straight to GDAL's /vsis3/
+    # and only has GDAL's in-process caching, anything else (local or /vsi paths) is passed through
+    def vsi_path(self, fn):
+        if fn.startswith(('http://', 'https://')):
+            return '/vsicurl/http://127.0.0.1:%d/%s' % (self.server.server_address[1], urllib.parse.quote(fn, safe=''))
+        if fn.startswith('s3://'):
+            return '/vsis3/' + fn[len('s3://'):]
+        return fn
+
+    # Register an opened input so its blocks are planned ahead - only http(s) inputs go through the cache
+    def add_source(self, fn, dataset, bands):
+        if fn.startswith(('http://', 'https://')):
+            self.sources.append((fn, dataset, bands))
+
+    # Byte ranges every source needs for a window, so the window can be fetched before GDAL reads it
+    def plan(self, src_window, cols, rows):
+        plan = {}
+        for url, dataset, bands in self.sources:
+            for b in bands:
+                level, ranges = block_ranges(dataset.GetRasterBand(b), src_window, cols, rows)
+                plan.setdefault(self._level_url(level, url), set()).update(ranges)
+        return [(url, sorted(ranges)) for url, ranges in plan.items()]
+
+    # Remote URL holding a band level's blocks - GDAL opens an external .ovr sidecar through the
+    # local server as well, so its path decodes to the sidecar's own URL
+    def _level_url(self, level, url):
+        dataset = level.GetDataset()
+        path = dataset.GetDescription() if dataset is not None else ''
+        prefix = '/vsicurl/http://127.0.0.1:%d/' % self.server.server_address[1]
+        if path.startswith(prefix):
+            return urllib.parse.unquote(path[len(prefix):])
+        return url
+
+    def close(self):
+        self.sources = []
+        if self.server is not None:
+            self.server.shutdown()
+        self.prefetcher.shutdown()
+        self.pool.shutdown()
+
+
+class _CacheHandler(BaseHTTPRequestHandler):
+
+    def _url(self):
+        return urllib.parse.unquote(self.path[1:])
+
+    def do_HEAD(self):
+        length = self.server.cache.size(self._url())
+        if length is None:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Length', str(length))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.end_headers()
+
+    def do_GET(self):
+        url = self._url()
+        length = self.server.cache.size(url)
+        if length is None:
+            self.send_error(404)
+            return
+
+        match = re.match(r'bytes=(\d+)-(\d*)$', self.headers.get('Range', ''))
+        if match:
+            start = int(match.group(1))
+            end = min(int(match.group(2)), length - 1) if match.group(2) else length - 1
+            if start > end:
+                self.send_error(416)
+                return
+        else:
+            start, end = 0, length - 1
+
+        try:
+            data = self.server.cache.read(url, start, end) if length else b''
+        except (urllib.error.URLError, OSError):
+            self.send_error(502)
+            return
+        if match:
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, end, length))
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(data)))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+
+# Smoke check for -remote, run by hand with python tools/check_remote.py.
+# Serves a synthetic L8-style scene from a local HTTP server that honours Range requests, runs ndvi.py and ndsi.py
+# against it through a shared on-disk cache, and checks the reported GET requests and bytes against what the server
+# actually sent, that the second index reuses the first one's tiles, and that remote output matches a local run.
+
+# system libraries and imports
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+# import third party
+import numpy as np
+from osgeo import gdal
+
+BIN_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'bin')
+TILE_SIZE = 256
+
+
+# SimpleHTTPRequestHandler ignores Range - answer single byte ranges with 206 and count what is sent
+class RangeRequestHandler(SimpleHTTPRequestHandler):
+
+    def do_GET(self):
+        path = self.translate_path(self.path)
+        match = re.match(r'bytes=(\d+)-(\d*)$', self.headers.get('Range', ''))
+        if not match or not os.path.isfile(path):
+            return SimpleHTTPRequestHandler.do_GET(self)
+
+        length = os.path.getsize(path)
+        start = int(match.group(1))
+        end = min(int(match.group(2)), length - 1) if match.group(2) else length - 1
+        with open(path, 'rb') as f:
+            f.seek(start)
+            data = f.read(end - start + 1)
+
+        # Count before sending so the totals are complete once the client has its response
+        with self.server.lock:
+            self.server.gets += 1
+            self.server.bytes_sent += len(data)
+
+        self.send_response(206)
+        self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, end, length))
+        self.send_header('Content-Length', str(len(data)))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def make_scene(fn, xsize=2100, ysize=1500):
+    # Six-band pixel-interleaved tiled reflectance scene, larger than one 1024 x 1024 window
+    rng = np.random.default_rng(0)
+    ds = gdal.GetDriverByName('GTiff').Create(fn, xsize, ysize, 6, gdal.GDT_Float32,
+                                              options=['TILED=YES', 'BLOCKXSIZE=%i' % TILE_SIZE, 'BLOCKYSIZE=%i' % TILE_SIZE,
+                                                       'INTERLEAVE=PIXEL', 'COMPRESS=LZW'])
+    ds.SetGeoTransform((500000, 30, 0, 4000000, 0, -30))
+    for b in range(1, 7):
+        ds.GetRasterBand(b).WriteArray(rng.uniform(-0.05, 1, (ysize, xsize)).astype('float32'))
+    ds = None
+    return -(-xsize // TILE_SIZE) * -(-ysize // TILE_SIZE)
+
+
+def run_index(script, in_fn, out_fn, extra=()):
+    cmd = [sys.executable, os.path.join(BIN_DIR, script), '-in', in_fn, '-in_sensor', 'L8', '-out', out_fn] + list(extra)
+    output = subprocess.run(cmd, check=True, stdout=subprocess.PIPE, universal_newlines=True).stdout
+    match = re.search(r'Remote: (\d+) GET requests, (\d+) bytes fetched', output)
+    return (int(match.group(1)), int(match.group(2))) if match else None
+
+
+def read_output(fn):
+    ds = gdal.Open(fn)
+    arr = ds.ReadAsArray()
+    ds = None
+    return arr
+
+
+def main():
+    failures = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        scene_dir = os.path.join(tmp_dir, 'scenes')
+        os.makedirs(scene_dir)
+        scene_fn = os.path.join(scene_dir, 'LC08_scene.tif')
+        tiles = make_scene(scene_fn)
+
+        server = ThreadingHTTPServer(('127.0.0.1', 0), partial(RangeRequestHandler, directory=scene_dir))
+        server.lock = threading.Lock()
+        server.gets = 0
+        server.bytes_sent = 0
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = 'http://127.0.0.1:%d/LC08_scene.tif' % server.server_address[1]
+        remote_args = ['-remote', '-cache_dir', os.path.join(tmp_dir, 'cache'), '-cache_mb', '256']
+
+        for script in ('ndvi.py', 'ndsi.py'):
+            local_out = os.path.join(tmp_dir, script[:-3] + '_local.tif')
+            remote_out = os.path.join(tmp_dir, script[:-3] + '_remote.tif')
+            run_index(script, scene_fn, local_out)
+
+            gets_before, bytes_before = server.gets, server.bytes_sent
+            requests, fetched = run_index(script, url, remote_out, remote_args)
+            served_gets = server.gets - gets_before
+            served_bytes = server.bytes_sent - bytes_before
+            print(script, "reported", requests, "GET requests /", fetched, "bytes;",
+                  "server sent", served_gets, "/", served_bytes)
+
+            if (requests, fetched) != (served_gets, served_bytes):
+                failures.append("%s: reported GETs/bytes do not match the server" % script)
+            if not np.array_equal(read_output(local_out), read_output(remote_out), equal_nan=True):
+                failures.append("%s: remote output differs from local output" % script)
+
+            if script == 'ndvi.py':
+                # Pixel-interleaved tiles hold every band, so one request per tile would be the uncoalesced count
+                if requests == 0 or requests >= tiles:
+                    failures.append("ndvi.py: expected fewer than %i coalesced requests, got %i" % (tiles, requests))
+                first_fetched = fetched
+            elif fetched >= first_fetched:
+                failures.append("ndsi.py: fetched %i bytes, expected tiles cached by ndvi.py to be reused" % fetched)
+
+        server.shutdown()
+
+    for failure in failures:
+        print("FAIL:", failure)
+    if failures:
+        sys.exit(1)
+    print("PASS")
+
+
+if __name__ == "__main__":
+    main()